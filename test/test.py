@@ -2,118 +2,140 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import cocotb
+import numpy as np
 from cocotb.clock import Clock
-from cocotb.triggers import ClockCycles, RisingEdge, FallingEdge
+from cocotb.triggers import (
+    FallingEdge,
+    NextTimeStep,
+    ReadOnly,
+    RisingEdge,
+    Timer,
+)
 
+CLOCK_PERIOD_US = 10
 
-def hi8(v: int) -> int:
-    return (v & 0xFFFF) >> 8
+# ui_in words for load_mode: op_type=11, data[5:4]=mode, data[3]=1(enable)
+MODE_WORDS = tuple((0b11 << 6) | (m << 4) | (1 << 3) for m in range(4))
+# ui_in mask for sample words: op_type=00, data[5:0]=sample
+SAMPLE_MASK = 0x3F
 
 
-def filt_value(hist, coeffs):
-    x0, x1, x2, x3 = hist
-    h0, h1, h2, h3 = coeffs
-    y = x0 * h0 + x1 * h1 + x2 * h2 + x3 * h3
-    return y & 0xFFFF
+# Map every non-01 logic character to 0 for logic_to_int_allow_x.
+_NON01_TO_0 = str.maketrans(dict.fromkeys("xXzZuUwWlLhH-?", "0"))
 
 
 def logic_to_int_allow_x(value) -> int:
-    bits = str(value).lower()
-    clean = "".join(ch if ch in ("0", "1") else "0" for ch in bits)
-    return int(clean, 2)
+    return int(str(value).translate(_NON01_TO_0), 2)
 
 
 def try_logic_to_int(value):
-    if getattr(value, "is_resolvable", False):
-        return int(value)
-    try:
-        return int(value)
-    except ValueError:
-        return None
-
-
-async def write_ui(dut, value: int):
-    dut.ui_in.value = value & 0xFF
-    await RisingEdge(dut.clk)
+    return int(value) if value.is_resolvable else None
 
 
 async def apply_reset(dut, cycles: int = 5):
     dut.ui_in.value = 0
     dut.uio_in.value = 0
     dut.rst_n.value = 0
-    await ClockCycles(dut.clk, cycles)
+    # rst_n is asynchronous, so hold it for the same time with a single Timer
+    # rather than counting edges. The Timer can end on a rising edge, so
+    # release on the next falling edge to keep it clear of the flops.
+    await Timer(cycles * CLOCK_PERIOD_US, unit="us")
+    await FallingEdge(dut.clk)
     dut.rst_n.value = 1
     await RisingEdge(dut.clk)
 
 
 async def load_mode(dut, mode: int):
-    # op_type=11, data[5:4]=mode, data[3]=1(enable)
-    await write_ui(dut, (0b11 << 6) | ((mode & 0x3) << 4) | (1 << 3))
-
-
-async def send_sample(dut, sample: int):
-    # op_type=00, data[5:0]=sample
-    await write_ui(dut, sample & 0x3F)
+    dut.ui_in.value = MODE_WORDS[mode & 0x3]
+    await RisingEdge(dut.clk)
 
 
 async def read_coeff6(dut, sel: int) -> int:
+    uio_out = dut.uio_out
     dut.uio_in.value = sel & 0x3
-    raw = None
-
-    for _ in range(8):
-        await RisingEdge(dut.clk)
-        await FallingEdge(dut.clk)
-        raw = dut.uio_out.value
+    await RisingEdge(dut.clk)
+    await ReadOnly()
+    raw = uio_out.value
+    parsed = try_logic_to_int(raw)
+    # Leave the read-only phase so the caller can drive inputs again.
+    await NextTimeStep()
+
+    if parsed is None:
+        # Gate-level can briefly expose X/Z; give it one more time step.
+        await ReadOnly()
+        raw = uio_out.value
         parsed = try_logic_to_int(raw)
-        if parsed is not None:
-            return (parsed >> 2) & 0x3F
+        await NextTimeStep()
+
+    if parsed is not None:
+        return (parsed >> 2) & 0x3F
 
-    # Gate-level can briefly expose X/Z; coerce non-01 bits to 0 as fallback.
+    # Still unresolved; coerce non-01 bits to 0 as fallback.
     return (logic_to_int_allow_x(raw) >> 2) & 0x3F
 
 
 async def check_stream_mode(dut, samples, coeffs, mode_name: str):
-    # y_output_reg captures previous cycle's FIR result, so compare against
-    # an expected value delayed by one sample cycle.
-    hist = [0, 0, 0, 0]
-    expected_delayed = 0
-
     dut._log.info(
         f"[{mode_name}] coeffs={coeffs} samples={samples}"
     )
 
-    for idx, sample in enumerate(samples):
-        await send_sample(dut, sample)
-        await FallingEdge(dut.clk)
-
-        got_raw = dut.uo_out.value
-        got = try_logic_to_int(got_raw)
-        if got is None:
-            got = logic_to_int_allow_x(got_raw)
-        uio_raw = dut.uio_out.value
-        uio_val = try_logic_to_int(uio_raw)
-        if uio_val is None:
-            uio_val = logic_to_int_allow_x(uio_raw)
-
+    # Precompute the reference output for the whole stream: 16-bit wrapped
+    # FIR result, scaled to the upper 8 bits. y_output_reg captures previous
+    # cycle's FIR result, so compare against an expected value delayed by one
+    # sample cycle.
+    x = np.array(samples, dtype=np.int32) & SAMPLE_MASK
+    h = np.array(coeffs, dtype=np.int32)
+    y = np.convolve(x, h)[: len(x)] & 0xFFFF
+    exp = (y >> 8).astype(np.int32)
+    exp_delayed = np.concatenate([[0], exp[:-1]])
+
+    # Resolve handles once rather than on every sample.
+    clk = dut.clk
+    ui_in = dut.ui_in
+    uo_out = dut.uo_out
+    uio_out = dut.uio_out
+    captured = []
+
+    async def monitor():
+        # Sample outputs mid-cycle, once per driven sample, so the driver
+        # below only has to yield on the rising edge. Gate-level flops update
+        # a unit delay after the edge, so the edge's own ReadOnly is too early.
+        await RisingEdge(clk)
+        for _ in samples:
+            await FallingEdge(clk)
+            got_raw = uo_out.value
+            got = try_logic_to_int(got_raw)
+            if got is None:
+                got = logic_to_int_allow_x(got_raw)
+            uio_raw = uio_out.value
+            uio_val = try_logic_to_int(uio_raw)
+            if uio_val is None:
+                uio_val = logic_to_int_allow_x(uio_raw)
+            captured.append((got, uio_val))
+
+    monitor_task = cocotb.start_soon(monitor())
+    for sample in samples:
+        ui_in.value = sample & SAMPLE_MASK
+        await RisingEdge(clk)
+    await monitor_task
+
+    for idx, (sample, (got, uio_val)) in enumerate(zip(samples, captured)):
+        expected_delayed = int(exp_delayed[idx])
+        # Samples already in the delay line, oldest first.
+        prev = samples[max(0, idx - len(coeffs)):idx]
         dut._log.info(
             f"[{mode_name}] step={idx} sample={sample:02d} "
-            f"hist={hist} exp=0x{expected_delayed:02x} got=0x{got:02x} "
+            f"prev={prev} exp=0x{expected_delayed:02x} got=0x{got:02x} "
             f"uio_out=0x{uio_val:02x}"
         )
         assert got == expected_delayed, (
-            f"{mode_name} sample={sample}, hist={hist}, "
+            f"{mode_name} sample={sample}, prev={prev}, "
             f"expected=0x{expected_delayed:02x}, got=0x{got:02x}"
         )
 
-        hist = [sample & 0x3F, hist[0], hist[1], hist[2]]
-        expected_delayed = hi8(filt_value(hist, coeffs))
-
 
-@cocotb.test()
-async def test_project(dut):
-    dut._log.info("Start enhanced FIR protocol test")
-
-    clock = Clock(dut.clk, 10, unit="us")
+async def start_and_reset(dut):
+    clock = Clock(dut.clk, CLOCK_PERIOD_US, unit="us")
     cocotb.start_soon(clock.start())
 
     dut.ena.value = 1
@@ -121,17 +143,26 @@ async def test_project(dut):
     dut.uio_in.value = 0
     await apply_reset(dut)
 
+
+# Each test below can also run on its own via `make tests`; keep the TESTS
+# list in the Makefile in sync when adding, renaming or removing one.
+@cocotb.test()
+async def test_readback(dut):
     # Verify low-pass preset readback: h=[4,2,1,1]
     dut._log.info("Checking low-pass preset coefficient readback")
+    await start_and_reset(dut)
     await load_mode(dut, 0b10)
     assert await read_coeff6(dut, 0b00) == 4
     assert await read_coeff6(dut, 0b01) == 2
     assert await read_coeff6(dut, 0b10) == 1
     assert await read_coeff6(dut, 0b11) == 1
 
+
+@cocotb.test()
+async def test_bypass(dut):
     # Functional check in bypass mode: y = x0
     dut._log.info("Checking bypass mode")
-    await apply_reset(dut)
+    await start_and_reset(dut)
     await load_mode(dut, 0b00)
     await check_stream_mode(
         dut=dut,
@@ -140,9 +171,12 @@ async def test_project(dut):
         mode_name="bypass",
     )
 
+
+@cocotb.test()
+async def test_moving_avg(dut):
     # Functional check in moving average mode: y = x0 + x1 + x2 + x3
     dut._log.info("Checking moving-average mode")
-    await apply_reset(dut)
+    await start_and_reset(dut)
     await load_mode(dut, 0b01)
     await check_stream_mode(
         dut=dut,
@@ -151,9 +185,12 @@ async def test_project(dut):
         mode_name="moving-average",
     )
 
+
+@cocotb.test()
+async def test_highpass(dut):
     # Functional check in high-pass mode: y = x0 - x1
     dut._log.info("Checking high-pass mode")
-    await apply_reset(dut)
+    await start_and_reset(dut)
     await load_mode(dut, 0b11)
     await check_stream_mode(
         dut=dut,
@@ -165,5 +202,3 @@ async def test_project(dut):
     # Sanity: coeff readback of h1 in high-pass is -1 => 0xFF => low 6 bits 0x3F
     h1_rb = await read_coeff6(dut, 0b01)
     assert h1_rb == 0x3F, f"expected h1 readback 0x3F, got 0x{h1_rb:02x}"
-
-    dut._log.info("Enhanced FIR protocol test passed")